@@ -15,6 +15,9 @@ import asyncio
 import shutil
 import sys
 import logging
+import logging.handlers
+import queue
+import atexit
 import requests
 from dotenv import load_dotenv
 
@@ -31,9 +34,23 @@ if os.getenv("MAX_NEW_TOKENS") is not None:
     MAX_NEW_TOKENS = os.getenv("MAX_NEW_TOKENS")
 else:
     MAX_NEW_TOKENS = 300
+# Stream koboldcpp generations token by token when set to T
+KOBOLD_STREAMING = str(os.getenv("KOBOLD_STREAMING", "F")).lower() == "t"
 
 intents = discord.Intents.all()
-bot = Bot(command_prefix="/", intents=intents, help_command=None)
+
+
+class PygBot(Bot):
+    async def close(self) -> None:
+        # The LLM belongs to the bot, so release its HTTP sessions and cache
+        # handle on shutdown rather than when a cog is reloaded
+        llm = getattr(self, "llm", None)
+        if hasattr(llm, "aclose"):
+            await llm.aclose()
+        await super().close()
+
+
+bot = PygBot(command_prefix="/", intents=intents, help_command=None)
 bot.endpoint = str(ENDPOINT)
 if len(bot.endpoint.split("/api")) > 0:
     bot.endpoint = bot.endpoint.split("/api")[0]
@@ -51,6 +68,23 @@ characters_folder = "Characters"
 cards_folder = "Cards"
 characters = []
 
+# Route KoboldAI client logs through a queue so a background thread does the
+# console writes instead of the event loop
+log_queue = queue.Queue(-1)
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(
+    logging.Formatter(
+        "[{asctime}] [{levelname:<8}] {name}: {message}", "%Y-%m-%d %H:%M:%S", style="{"
+    )
+)
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+kobold_logger = logging.getLogger("helpers.koboldai")
+kobold_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+kobold_logger.setLevel(logging.DEBUG if bot.debug else logging.INFO)
+kobold_logger.propagate = False
+log_listener.start()
+atexit.register(log_listener.stop)
+
 
 def upload_character(json_file, img, tavern=False):
     json_file = json_file if type(json_file) == str else json_file.decode("utf-8")
@@ -183,7 +217,9 @@ else:
 llm_selected = input("Select LLM (1: Kobold, 2: Oobabooga): ")
 if llm_selected == "1":
     bot.endpoint_type = "Kobold"
-    bot.llm = KoboldApiLLM(endpoint=bot.endpoint, max_length=MAX_NEW_TOKENS)
+    bot.llm = KoboldApiLLM(
+        endpoint=bot.endpoint, max_length=MAX_NEW_TOKENS, streaming=KOBOLD_STREAMING
+    )
 elif llm_selected == "2":
     bot.endpoint_type = "Oobabooga"
     bot.llm = TextGen(model_url=bot.endpoint, max_new_tokens=MAX_NEW_TOKENS)
@@ -240,7 +276,7 @@ async def on_ready():
 
     # Check if the endpoint is connected to koboldcpp
     if bot.llm._llm_type == "koboldai":
-        bot.koboldcpp_version = bot.llm.check_version()
+        bot.koboldcpp_version = await bot.llm.check_version()
         print(f"KoboldCPP Version: {bot.koboldcpp_version}")
     else:
         bot.koboldcpp_version = 0.0
@@ -0,0 +1,99 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class LRUCache:
+    """Bounded least-recently-used cache with an optional time-to-live.
+
+    Entries older than ``ttl`` seconds are treated as missing, and the oldest
+    entry is evicted once ``maxsize`` is exceeded. Operations never block on
+    I/O, so a plain lock keeps it safe for both threads and the event loop.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl is not None and time.monotonic() - stored_at > self.ttl
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, stored_at = item
+            if self._expired(stored_at):
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SqliteCache:
+    """String cache persisted to a SQLite file so entries survive restarts.
+
+    Entries older than ``ttl`` seconds are ignored on read and purged every
+    ``purge_every`` writes. Calls block on disk I/O, so async callers should
+    run them with ``asyncio.to_thread``.
+    """
+
+    def __init__(self, path: str, ttl: float, purge_every: int = 100):
+        self.path = path
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache(key TEXT PRIMARY KEY, value TEXT, ts INTEGER)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cache_ts ON cache(ts)")
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM cache WHERE key=? AND ts>?",
+                (key, int(time.time() - self.ttl)),
+            ).fetchone()
+        return row[0] if row is not None else default
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache(key, value, ts) VALUES (?, ?, ?)",
+                (key, value, int(time.time())),
+            )
+            self._writes += 1
+            if self._writes % self.purge_every == 0:
+                self._conn.execute(
+                    "DELETE FROM cache WHERE ts<?", (int(time.time() - self.ttl),)
+                )
+
+    def clear(self) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cache")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -1,21 +1,93 @@
+import hashlib
+import json
 import logging
-from typing import Any, Dict, List, Optional
+import os
+import re
+from typing import Any, AsyncIterator, Dict, List, Optional
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import asyncio
 import aiohttp
 
-import random
-import string
+import secrets
+import threading
 
 from langchain.callbacks.manager import  (
     AsyncCallbackManagerForLLMRun,
     CallbackManagerForLLMRun,
 )
 from langchain.llms.base import LLM
+from langchain.pydantic_v1 import PrivateAttr, validator
+from langchain.schema.output import GenerationChunk
+
+from helpers.cache import LRUCache, SqliteCache
 
 logger = logging.getLogger(__name__)
 
+# Response cache limits
+MAX_ENTRIES = 1000
+TTL_SECONDS = 3600
+
+# Default number of generate requests in flight against the backend at once
+DEFAULT_MAX_CONCURRENCY = 4
+
+# Extra pooled connections kept free for abort and version requests
+ABORT_HEADROOM = 2
+
+# Random bytes per genkey; token_urlsafe encodes 8 bytes as 11 characters
+GENKEY_BYTES = 8
+
+# Maximum number of channels to remember in-flight genkeys for, and for how long
+MAX_GENKEYS = 10_000
+GENKEY_TTL_SECONDS = 3600
+
+# Above this temperature generations are too random to be worth caching
+CACHE_MAX_TEMPERATURE = 0.2
+
+# Model fields sent unchanged with every generate request
+_BASE_PARAM_FIELDS = (
+    "use_story",
+    "use_authors_note",
+    "use_world_info",
+    "use_memory",
+    "max_context_length",
+    "max_length",
+    "rep_pen",
+    "rep_pen_range",
+    "rep_pen_slope",
+    "temperature",
+    "tfs",
+    "top_a",
+    "top_p",
+    "top_k",
+    "typical",
+)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Timeout in seconds for each API version probe
+VERSION_PROBE_TIMEOUT = 10
+
+# Default (connect, read) timeout for blocking requests to the Kobold API
+REQUEST_TIMEOUT = (10, 600)
+
+def _normalize_prompt(prompt: str) -> str:
+    """Collapse whitespace and case so trivially different prompts share a cache key."""
+    return _WHITESPACE_RE.sub(" ", prompt).strip().lower()
+
+def _make_http_session() -> requests.Session:
+    """Create a requests session with pooled keep-alive connections."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
 def clean_url(url: str) -> str:
     """Remove trailing slash and /api from url if present."""
     if url.endswith("/api"):
@@ -129,44 +201,208 @@ class KoboldApiLLM(LLM):
     minimum: 0
     """
 
-    # To store genkeys for each generation
-    genkeys = {}
+    max_concurrency: Optional[int] = None
+    """Maximum number of generate requests sent to the backend at once.
+
+    Defaults to the KOBOLD_MAX_CONCURRENCY environment variable, or 4 if unset.
+    minimum: 1
+    """
+
+    cache_path: Optional[str] = "kobold_cache.db"
+    """SQLite file that persists cached responses across restarts. None keeps them in memory only."""
+
+    streaming: bool = False
+    """Whether to stream the results token by token. Only supported by koboldcpp."""
+
     is_koboldcpp = False
 
+    # To store genkeys for each generation, bounded so idle channels age out
+    _genkeys: LRUCache = PrivateAttr(
+        default_factory=lambda: LRUCache(MAX_GENKEYS, GENKEY_TTL_SECONDS)
+    )
+
+    # Shared aiohttp session, created lazily inside the running event loop
+    _session: Optional[aiohttp.ClientSession] = PrivateAttr(default=None)
+    _session_lock: asyncio.Lock = PrivateAttr(default_factory=asyncio.Lock)
+
+    # Limits concurrent generate requests sent to the backend
+    _gen_semaphore: Optional[asyncio.Semaphore] = PrivateAttr(default=None)
+
+    # Shared requests session for the blocking calls
+    _http: requests.Session = PrivateAttr(default_factory=_make_http_session)
+
+    # Cache of generated text keyed by a hash of the request body
+    _cache: LRUCache = PrivateAttr(
+        default_factory=lambda: LRUCache(MAX_ENTRIES, TTL_SECONDS)
+    )
+
+    # Persistent second tier behind _cache, opened on first use
+    _disk_cache: Optional[SqliteCache] = PrivateAttr(default=None)
+    _disk_cache_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    # Endpoint URLs, derived from endpoint once rather than on every request
+    _base_url: str = PrivateAttr(default="")
+    _generate_url: str = PrivateAttr(default="")
+    _abort_url: str = PrivateAttr(default="")
+    _stream_url: str = PrivateAttr(default="")
+
+    # Sampler parameters shared by every request, rebuilt when a field changes
+    _base_params: Optional[Dict[str, Any]] = PrivateAttr(default=None)
+
+    # Backend and model reported by check_version, part of every cache key
+    _backend_id: Optional[str] = PrivateAttr(default=None)
+
     @property
     def _llm_type(self) -> str:
         return "koboldai"
 
+    @validator("max_concurrency", pre=True, always=True)
+    def _validate_max_concurrency(cls, value: Any) -> int:
+        """Read the limit from the environment if unset and require at least 1."""
+        if value is None:
+            value = os.getenv("KOBOLD_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY)
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"max_concurrency must be an integer, got {value!r}")
+        if value < 1:
+            raise ValueError(f"max_concurrency must be at least 1, got {value}")
+        return value
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._update_urls()
+        self._gen_semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        super().__setattr__(name, value)
+        if name in _BASE_PARAM_FIELDS:
+            self._base_params = None
+        elif name == "endpoint":
+            self._update_urls()
+            self._backend_id = None
+
+    def _update_urls(self) -> None:
+        """Precompute the API URLs from the configured endpoint."""
+        self._base_url = clean_url(self.endpoint)
+        self._generate_url = f"{self._base_url}/api/v1/generate"
+        self._abort_url = f"{self._base_url}/api/extra/abort"
+        self._stream_url = f"{self._base_url}/api/extra/generate/stream"
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared aiohttp session, creating it on first use."""
+        async with self._session_lock:
+            if self._session is None or self._session.closed:
+                # Size the pool to the generation limit so channels share a few kept-alive
+                # sockets, with headroom so aborts never wait behind running generations
+                connector = aiohttp.TCPConnector(
+                    limit=self.max_concurrency + ABORT_HEADROOM,
+                    limit_per_host=self.max_concurrency + ABORT_HEADROOM,
+                    keepalive_timeout=75,
+                    ttl_dns_cache=300,
+                )
+                self._session = aiohttp.ClientSession(
+                    connector=connector,
+                    timeout=aiohttp.ClientTimeout(
+                        total=None,
+                        sock_connect=REQUEST_TIMEOUT[0],
+                        sock_read=REQUEST_TIMEOUT[1],
+                    ),
+                )
+            return self._session
+
+    async def aclose(self) -> None:
+        """Close the shared HTTP sessions, if any were opened."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._http.close()
+        if self._disk_cache is not None:
+            self._disk_cache.close()
+            self._disk_cache = None
+
     # Define a helper method to generate the data dict
     def _get_parameters(
         self,
         prompt: str,
         stop: Optional[List[str]] = None) -> Dict[str, Any]:
         """Get the parameters to send to the API."""
-        data: Dict[str, Any] = {
-            "prompt": prompt,
-            "use_story": self.use_story,
-            "use_authors_note": self.use_authors_note,
-            "use_world_info": self.use_world_info,
-            "use_memory": self.use_memory,
-            "max_context_length": self.max_context_length,
-            "max_length": self.max_length,
-            "rep_pen": self.rep_pen,
-            "rep_pen_range": self.rep_pen_range,
-            "rep_pen_slope": self.rep_pen_slope,
-            "temperature": self.temperature,
-            "tfs": self.tfs,
-            "top_a": self.top_a,
-            "top_p": self.top_p,
-            "top_k": self.top_k,
-            "typical": self.typical,
-        }
+        if self._base_params is None:
+            self._base_params = {
+                name: getattr(self, name) for name in _BASE_PARAM_FIELDS
+            }
+
+        data: Dict[str, Any] = {"prompt": prompt, **self._base_params}
 
         if stop:
             data["stop_sequence"] = stop
 
         return data
 
+    def _strip_stops(self, text: str, stop: List[str]) -> str:
+        """Remove trailing stop sequences from the generated text."""
+        # One C-level check covers the common case where no stop sequence matches
+        if not text.endswith(tuple(stop)):
+            return text
+        for sequence in stop:
+            if sequence and text.endswith(sequence):
+                text = text[: -len(sequence)].rstrip()
+        return text
+
+    def _cache_key(self, data: Dict[str, Any]) -> Optional[str]:
+        """Return the cache key for a request, or None if it should not be cached."""
+        if self.temperature is None or self.temperature > CACHE_MAX_TEMPERATURE:
+            return None
+        # Round sampler floats so jitter doesn't fragment keys; the request body
+        # itself still carries the original prompt and values
+        key_data = {
+            name: round(value, 2) if isinstance(value, float) else value
+            for name, value in data.items()
+        }
+        key_data["prompt"] = _normalize_prompt(data["prompt"])
+        # Scope keys to the server and model so persisted replies never leak
+        # across endpoints or model swaps
+        key_data["endpoint"] = self._base_url
+        key_data["backend"] = self._backend_id
+        canonical = json.dumps(key_data, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def _get_disk_cache(self) -> Optional[SqliteCache]:
+        """Return the persistent cache, opening the SQLite file on first use."""
+        if self.cache_path is None:
+            return None
+        with self._disk_cache_lock:
+            if self._disk_cache is None:
+                self._disk_cache = SqliteCache(self.cache_path, TTL_SECONDS)
+            return self._disk_cache
+
+    def _disk_cache_get(self, key: str) -> Optional[str]:
+        """Look a response up on disk, promoting hits into the in-memory cache."""
+        # Without a known model a persisted reply could come from another one
+        if self._backend_id is None:
+            return None
+        disk_cache = self._get_disk_cache()
+        if disk_cache is None:
+            return None
+        text = disk_cache.get(key)
+        if text is not None:
+            self._cache.set(key, text)
+        return text
+
+    def _disk_cache_set(self, key: str, text: str) -> None:
+        if self._backend_id is None:
+            return
+        disk_cache = self._get_disk_cache()
+        if disk_cache is not None:
+            disk_cache.set(key, text)
+
+    def clear_cache(self) -> None:
+        """Drop all cached responses."""
+        self._cache.clear()
+        disk_cache = self._get_disk_cache()
+        if disk_cache is not None:
+            disk_cache.clear()
+
     def _call(
         self,
         prompt: str,
@@ -192,13 +428,23 @@ class KoboldApiLLM(LLM):
                 llm("Write a story about dragons.")
         """
         data = self._get_parameters(prompt, stop)
-
-        response = requests.post(
-            f"{clean_url(self.endpoint)}/api/v1/generate", json=data
+        cache_key = self._cache_key(data)
+        if cache_key is not None:
+            cached = self._cache.get(cache_key)
+            if cached is None:
+                cached = self._disk_cache_get(cache_key)
+            if cached is not None:
+                return cached
+
+        response = self._http.post(
+            self._generate_url,
+            data=orjson.dumps(data),
+            headers=_JSON_HEADERS,
+            timeout=REQUEST_TIMEOUT,
         )
 
         response.raise_for_status()
-        json_response = response.json()
+        json_response = orjson.loads(response.content)
 
         if (
             "results" in json_response
@@ -207,10 +453,12 @@ class KoboldApiLLM(LLM):
         ):
             text = json_response["results"][0]["text"].strip()
 
-            if stop is not None:
-                for sequence in stop:
-                    if text.endswith(sequence):
-                        text = text[: -len(sequence)].rstrip()
+            if stop:
+                text = self._strip_stops(text, stop).rstrip()
+
+            if cache_key is not None:
+                self._cache.set(cache_key, text)
+                self._disk_cache_set(cache_key, text)
 
             return text
         else:
@@ -244,66 +492,169 @@ class KoboldApiLLM(LLM):
                 llm = KoboldApiLLM(endpoint="http://localhost:5000")
                 llm("Write a story about dragons.")
         """
-        if self.is_koboldcpp:
-            # Generate a random 10 character genkey
-            genkey = "".join(random.choices(string.ascii_uppercase + string.digits, k=10))
-            print(f"genkey: {genkey}")
-
-            # Store genkeys to dict mapped to channel ID
-            self.genkeys[channel_id] = genkey
-            data = self._get_parameters(prompt, stop)
-            data["genkey"] = genkey
+        data = self._get_parameters(prompt, stop)
+        cache_key = self._cache_key(data)
+        if cache_key is not None:
+            # SQLite lookups run in a worker thread to keep the event loop free
+            cached = self._cache.get(cache_key)
+            if cached is None:
+                cached = await asyncio.to_thread(self._disk_cache_get, cache_key)
+            if cached is not None:
+                return cached
+
+        if self.streaming and self.is_koboldcpp:
+            combined_text_output = ""
+            async for chunk in self._astream(
+                prompt=prompt, stop=stop, run_manager=run_manager, channel_id=channel_id, **kwargs
+            ):
+                combined_text_output += chunk.text
+            text = combined_text_output.strip()
 
         else:
-            # Normal for KoboldAI, genkey is not required
-            data = self._get_parameters(prompt, stop)
+            if self.is_koboldcpp:
+                self._register_genkey(data, channel_id)
+
+            # Use the shared aiohttp session to call KoboldAI API asynchronously to prevent blocking.
+            # The semaphore queues excess generations here instead of piling them onto the backend.
+            session = await self._get_session()
+            async with self._gen_semaphore:
+                async with session.post(
+                    self._generate_url,
+                    data=orjson.dumps(data),
+                    headers=_JSON_HEADERS,
+                ) as response:
+                    response.raise_for_status()
+                    json_response = orjson.loads(await response.read())
+
+            if not (
+                "results" in json_response
+                and len(json_response["results"]) > 0
+                and "text" in json_response["results"][0]
+            ):
+                raise ValueError(
+                    f"Unexpected response format from Kobold API:  {json_response}"
+                )
+
+            text = json_response["results"][0]["text"].strip()
+
+        if stop:
+            text = self._strip_stops(text, stop).rstrip()
+
+        if cache_key is not None:
+            self._cache.set(cache_key, text)
+            await asyncio.to_thread(self._disk_cache_set, cache_key, text)
+
+        return text
+
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        channel_id: Optional[str] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        """Yields tokens from the koboldcpp SSE stream as they are generated.
 
-         # Use aiohttp to call KoboldAI API asynchronously to prevent blocking
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{clean_url(self.endpoint)}/api/v1/generate", json=data) as response:
+        It also calls the callback manager's on_llm_new_token event for each token,
+        so callers can update partial replies while the generation is running.
 
+        Args:
+            prompt: The prompt to use for generation.
+            stop: A list of strings to stop generation when encountered.
+
+        Yields:
+            GenerationChunk objects each holding one token of text.
+        """
+        if not self.is_koboldcpp:
+            raise ValueError("Streaming generation is only supported by koboldcpp.")
+
+        data = self._get_parameters(prompt, stop)
+        self._register_genkey(data, channel_id)
+
+        session = await self._get_session()
+        async with self._gen_semaphore:
+            async with session.post(
+                self._stream_url,
+                data=orjson.dumps(data),
+                headers=_JSON_HEADERS,
+            ) as response:
                 response.raise_for_status()
-                json_response = await response.json()
-
-                if (
-                    "results" in json_response
-                    and len(json_response["results"]) > 0
-                    and "text" in json_response["results"][0]
-                ):
-                    text = json_response["results"][0]["text"].strip()
-
-                    if stop is not None:
-                        for sequence in stop:
-                            if text.endswith(sequence):
-                                text = text[: -len(sequence)].rstrip()
-
-                    return text
-                else:
-                    raise ValueError(
-                        f"Unexpected response format from Kobold API:  {json_response}"
-                    )
-
-    def check_version(self) -> float:
+
+                # Each event carries a single token in a "data: {...}" line
+                async for line in response.content:
+                    if not line.startswith(b"data:"):
+                        continue
+                    token = orjson.loads(line[5:]).get("token", "")
+                    if not token:
+                        continue
+
+                    yield GenerationChunk(text=token)
+                    if run_manager:
+                        await run_manager.on_llm_new_token(token=token)
+
+    def _register_genkey(self, data: Dict[str, Any], channel_id: Optional[str]) -> None:
+        """Attach a fresh genkey to the request so the channel's generation can be aborted."""
+        # Generate a random URL-safe genkey
+        genkey = secrets.token_urlsafe(GENKEY_BYTES)
+        logger.debug("genkey: %s", genkey)
+
+        # Store genkeys to dict mapped to channel ID
+        self._genkeys.set(channel_id, genkey)
+        data["genkey"] = genkey
+
+    async def check_version(self) -> float:
         """Check the version of the koboldcpp API. To distinguish between KoboldAI and koboldcpp"""
-        try:
-            response = requests.get(f"{clean_url(self.endpoint)}/api/extra/version")
-            response.raise_for_status()
-            json_response = response.json()
-            self.is_koboldcpp = True
-            print("The endpoint is running koboldcpp instead of KoboldAI. If you use multiple channel IDs, please pass '--multiuser' to koboldcpp.")
-            return float(json_response["version"])
-        except:
-            # Try fetching KoboldAI version
+        session = await self._get_session()
+        timeout = aiohttp.ClientTimeout(total=VERSION_PROBE_TIMEOUT)
+
+        async def probe(path: str) -> Optional[Dict[str, Any]]:
             try:
-                response = requests.get(f"{clean_url(self.endpoint)}/api/v1/version")
-                response.raise_for_status()
-                json_response = response.json()
+                async with session.get(f"{self._base_url}{path}", timeout=timeout) as response:
+                    response.raise_for_status()
+                    return orjson.loads(await response.read())
+            except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError):
+                return None
+
+        async def model_probe() -> Optional[str]:
+            body = await probe("/api/v1/model")
+            try:
+                return str(body["result"])
+            except (KeyError, TypeError):
+                return None
+
+        async def koboldcpp_probe() -> Optional[float]:
+            body = await probe("/api/extra/version")
+            try:
+                return float(body["version"])
+            except (KeyError, TypeError, ValueError):
+                # A missing or malformed version counts as a failed probe
+                return None
+
+        # Probe both APIs at once; koboldcpp also serves /api/v1, so its own endpoint wins
+        koboldai_task = asyncio.create_task(probe("/api/v1/version"))
+        model_task = asyncio.create_task(model_probe())
+        try:
+            koboldcpp_version = await koboldcpp_probe()
+            if koboldcpp_version is not None:
+                self.is_koboldcpp = True
+                logger.info("The endpoint is running koboldcpp instead of KoboldAI. If you use multiple channel IDs, please pass '--multiuser' to koboldcpp.")
+                model = await model_task
+                self._backend_id = f"koboldcpp {koboldcpp_version}/{model}" if model else None
+                return koboldcpp_version
+
+            if await koboldai_task is not None:
                 self.is_koboldcpp = False
-                print("The endpoint is running KoboldAI instead of koboldcpp.")
+                logger.info("The endpoint is running KoboldAI instead of koboldcpp.")
+                model = await model_task
+                self._backend_id = f"koboldai/{model}" if model else None
                 return 0.0
-            except:
-                raise ValueError("The endpoint is not running KoboldAI or koboldcpp.")
+        finally:
+            # Don't leave the other probes running once the backend is known
+            koboldai_task.cancel()
+            model_task.cancel()
 
+        raise ValueError("The endpoint is not running KoboldAI or koboldcpp.")
 
     async def _stop(self, channel_id):
         """Send abort request to stop ongoing AI generation.
@@ -311,17 +662,26 @@ class KoboldApiLLM(LLM):
         """
 
         # Check genkey before cancelling
-        if channel_id in self.genkeys:
-            genkey = self.genkeys[channel_id]
+        genkey = self._genkeys.get(channel_id)
+        if genkey is None:
+            logger.debug("No ongoing AI generation to abort for channel ID of %s.", channel_id)
+            return
+
+        payload = {"genkey": genkey}
 
-            json = {"genkey": genkey}
-        
         try:
-            response = requests.post(f"{clean_url(self.endpoint)}/api/extra/abort", json=json)
-            if response.status_code == 200 and response.json()["success"] == True:
-                print(f"Successfully aborted AI generation for channel ID of {channel_id}, with genkey: {genkey}")
+            # Use the shared aiohttp session so the abort doesn't block the event loop
+            session = await self._get_session()
+            async with session.post(
+                self._abort_url,
+                data=orjson.dumps(payload),
+                headers=_JSON_HEADERS,
+            ) as response:
+                body = orjson.loads(await response.read())
+            if response.status == 200 and body.get("success") == True:
+                logger.info("Successfully aborted AI generation for channel ID of %s, with genkey: %s", channel_id, genkey)
             else:
-                print("Error aborting AI generation.")
+                logger.warning("Error aborting AI generation.")
 
         except Exception as e:
-            print(f"Error aborting AI generation: {e}")
\ No newline at end of file
+            logger.warning("Error aborting AI generation: %s", e)